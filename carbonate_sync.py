@@ -4,11 +4,14 @@ from __future__ import print_function
 
 import collections
 import errno
+import fcntl
 import getpass
 import inspect
 import itertools
+import locale
 import logging
 import multiprocessing
+import multiprocessing.pool
 import os
 import progressbar
 import random
@@ -19,15 +22,21 @@ import socket
 import subprocess
 import sys
 import tempfile
+import threading
 import time
+import zlib
 
 import whisper
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from carbon import util
 import carbonate.cli as carbonate_cli
 import carbonate.config as carbonate_config
 import carbonate.cluster as carbonate_cluster
-import carbonate.sieve as carbonate_sieve
 import carbonate.sync as carbonate_sync
 import carbonate.util as carbonate_util
 
@@ -35,8 +44,18 @@ import carbonate.util as carbonate_util
 if whisper.CAN_LOCK:
     whisper.LOCK = True
 
+# Healing a metric reads the same headers over and over (once per fetch
+# and update), cache them. The cache is cleared after each metric, see
+# _heal().
+whisper.CACHE_HEADERS = True
+
 _DEFAULT_TMP_DIR = tempfile.gettempdir()
 _MAX_PARALLEL_RSYNC = 4
+_MAX_PARALLEL_NODES = 8
+# Maximum number of metrics whose owner is remembered, see _Sieve.
+_SIEVE_CACHE_SIZE = 1000000
+# Number of lock files shared by all the metrics, see _heal_lock_path().
+_HEAL_LOCKS = 1024
 
 HAVE_HEAL_WITH_TIME_RANGE = (
     set(['start_time', 'end_time']) <=
@@ -59,7 +78,14 @@ SSH_OPTIONS = [
 ]
 
 RSYNC_OPTIONS = [
-    '--archive', '--sparse',
+    '--archive',
+    # Whisper files rarely share blocks with the staged copies, the delta
+    # transfer algorithm would mostly burn CPU. This sends more bytes when
+    # files only slightly changed.
+    '--whole-file',
+    # No temporary file and rename for each file, this is a staging dir.
+    # Incompatible with --sparse on older rsyncs.
+    '--inplace',
     '--update',
     # Keep files from a previous unfinished run, unless they are older than
     # a day
@@ -91,6 +117,8 @@ def _run(cmd, *args, **kwargs):
     """Starts a process and return its output."""
     kwargs.setdefault('stdout', subprocess.PIPE)
     kwargs.setdefault('stderr', subprocess.STDOUT)
+    # Get text instead of bytes on Python 3.
+    kwargs.setdefault('universal_newlines', True)
     popen = subprocess.Popen(cmd, *args, **kwargs)
     stdout, stderr = popen.communicate()
     if popen.wait():
@@ -98,35 +126,150 @@ def _run(cmd, *args, **kwargs):
         output = stderr or stdout or '<No output>'
         raise Error('Subcommand failed: %s: %s' % (description, output))
     if stdout:
-        return [l for l in stdout.split('\n') if l]
+        return stdout.splitlines()
+
+
+def _run_lines(cmd, *args, **kwargs):
+    """Starts a process and yields its output as it comes, line by line.
+
+    stderr is not captured and goes to our own stderr.
+    """
+    kwargs.setdefault('stdout', subprocess.PIPE)
+    kwargs.setdefault('universal_newlines', True)
+    popen = subprocess.Popen(cmd, *args, **kwargs)
+    try:
+        for line in popen.stdout:
+            line = line.rstrip('\n')
+            if line:
+                yield line
+    finally:
+        popen.stdout.close()
+        returncode = popen.wait()
+    if returncode:
+        description = ' '.join(cmd) if isinstance(cmd, list) else cmd
+        raise Error('Subcommand failed: %s: exit status %d' %
+                    (description, returncode))
 
 
-def _ssh(host, cmd, ssh_options=SSH_OPTIONS):
-    """ssh to an host and run a command."""
+def _ssh(host, cmd, ssh_options=SSH_OPTIONS, stream=False):
+    """ssh to an host and run a command.
+
+    If stream is True, returns an iterator over the output lines instead
+    of waiting for the command to complete.
+    """
     ssh_cmd = ['ssh'] + MANDATORY_SSH_OPTIONS + \
         ssh_options + [host, '--'] + cmd
+    if stream:
+        return _run_lines(ssh_cmd)
     return _run(ssh_cmd)
 
 
-def _filter_metrics(metrics, exclude):
-    """Exclude metrics matching a list of regexp."""
-    for pattern in exclude:
-        regex = re.compile(pattern)
-        metrics = [m for m in metrics if not regex.search(m)]
-    return metrics
+def _ssh_control_options(control_dir):
+    """ssh options to share connections, with sockets in control_dir.
+
+    This shares a single connection between the listing and all the rsyncs
+    to the same node instead of doing a new handshake each time.
+    control_dir must not be writable by other users, they could otherwise
+    get our connections.
+    """
+    return [
+        '-o', 'ControlMaster=auto',
+        '-o', 'ControlPath=' + os.path.join(control_dir, '%r@%h:%p'),
+        '-o', 'ControlPersist=60s',
+    ]
 
 
-def _list_metrics(config, local_cluster, local_node, remote_node, exclude,
-                  ssh_options=[]):
-    """List metrics on a remote node."""
+def _ssh_exit(host, ssh_options=SSH_OPTIONS):
+    """Stops the shared ssh connection to an host, if any."""
+    ssh_cmd = ['ssh'] + MANDATORY_SSH_OPTIONS + \
+        ssh_options + ['-O', 'exit', host]
+    try:
+        _run(ssh_cmd)
+    except Error:
+        # There was no connection to stop.
+        pass
 
-    metrics = _ssh(remote_node, ['carbon-list'], ssh_options=ssh_options)
-    metrics = _filter_metrics(metrics, exclude)
 
-    cluster = carbonate_cluster.Cluster(config, local_cluster)
-    metrics = carbonate_sieve.filterMetrics(
-        metrics, local_node, cluster, invert=False)
-    return sorted(metrics)
+class _AnyRegexp(object):
+
+    """Matches if any of several compiled regexps matches."""
+
+    def __init__(self, regexps):
+        self._regexps = regexps
+
+    def search(self, string):
+        return any(r.search(string) for r in self._regexps)
+
+
+def _compile_exclude(exclude):
+    """Compile a list of regexp in a single one matching any of them.
+
+    Raises re.error if one of them is invalid.
+    """
+    regexps = [re.compile(p) for p in exclude]
+    # A single alternation lets us do only one pass over the metrics, but
+    # it would change the meaning of inline flags and group numbers.
+    default_flags = re.compile('').flags
+    if any(r.flags != default_flags or r.groups for r in regexps):
+        return _AnyRegexp(regexps)
+    return re.compile('|'.join('(?:%s)' % p for p in exclude))
+
+
+def _filter_metrics(metrics, exclude_re):
+    """Lazily exclude metrics matching a regexp from _compile_exclude()."""
+    if exclude_re is None:
+        return iter(metrics)
+    return (m for m in metrics if not exclude_re.search(m))
+
+
+class _Sieve(object):
+
+    """Keeps the metrics that belong to a node of a cluster.
+
+    When remote nodes are replicas of each other, they have many metrics
+    in common. The owner of up to cache_size metrics is then remembered,
+    so that it is only looked up once for all of them.
+    """
+
+    def __init__(self, cluster, node, cache_size=0):
+        self._cluster = cluster
+        self._node = node
+        self._cache_size = cache_size
+        self._cache = {}
+
+    def _is_mine(self, metric):
+        # Like carbonate.sieve.filterMetrics(), match the host or the whole
+        # destination, without building sets for each metric.
+        for destination in self._cluster.getDestinations(metric):
+            if (destination[0] == self._node or
+                    ':'.join(map(str, destination)) == self._node):
+                return True
+        return False
+
+    def filter(self, metrics):
+        """Lazily filter metrics belonging to the node."""
+        cache = self._cache
+        for metric in metrics:
+            mine = cache.get(metric)
+            if mine is None:
+                mine = self._is_mine(metric)
+                if len(cache) < self._cache_size:
+                    cache[metric] = mine
+            if mine:
+                yield metric
+
+
+def _list_metrics(sieve, remote_node, exclude_re, ssh_options=[]):
+    """List metrics on a remote node that pass through sieve."""
+    # Filter metrics while they are being listed, only the ones we keep
+    # are held in memory.
+    metrics = _ssh(remote_node, ['carbon-list'], ssh_options=ssh_options,
+                   stream=True)
+    metrics = _filter_metrics(metrics, exclude_re)
+    metrics = sieve.filter(metrics)
+    # carbon-list walks the storage directory, so metrics already come
+    # grouped by directory and there is no need to sort them.
+    return list(metrics)
 
 
 def info(msg=''):
@@ -136,15 +279,17 @@ def info(msg=''):
 def _fetch_from_remote(batch):
     """Fetch a remote list of files using rsync."""
     remote = '%s@%s:%s/' % (batch.remote_user, batch.remote_node, STORAGE_DIR)
-    with tempfile.NamedTemporaryFile('w', delete=False) as f:
-        for m in batch.metrics_fs:
-            print(m, file=f)
-        f.flush()
+    fd, files_from = tempfile.mkstemp()
+    try:
+        # Write the whole list at once. Text mode, metric names are bytes
+        # on Python 2.
+        with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join(batch.metrics_view) + '\n')
         ssh_cmd = 'ssh ' + ' '.join(MANDATORY_SSH_OPTIONS + batch.ssh_options)
         cmd = [
             'rsync',
             '--rsh', ssh_cmd,
-            '--files-from=%s' % f.name,
+            '--files-from=%s' % files_from,
         ]
         cmd += batch.rsync_options
         cmd += [
@@ -152,76 +297,385 @@ def _fetch_from_remote(batch):
             batch.staging_dir,
         ]
         _run(cmd)
+    finally:
+        os.unlink(files_from)
 
     return batch
 
 
-def _make_staging_dir(base_dir, node):
-    """Creates the staging directory for this node."""
-    dirname = os.path.join(base_dir, node)
+def _makedirs(dirname):
+    """Creates a directory and its parents, if they don't exist."""
     try:
         os.makedirs(dirname)
     except OSError as exc:
         # Ignore already existing directories
         if exc.errno != errno.EEXIST or not os.path.isdir(dirname):
             raise
+
+
+def _make_staging_dir(base_dir, node):
+    """Creates the staging directory for this node."""
+    dirname = os.path.join(base_dir, node)
+    _makedirs(dirname)
     return dirname
 
 
+def _clear_header_cache():
+    """Forget whisper headers cached so far, to bound memory usage."""
+    getattr(whisper, '__headerCache').clear()
+
+
+if numpy is not None:
+    # Layout of whisper points, see whisper.pointFormat.
+    _POINT_DTYPE = numpy.dtype([('time', '>u4'), ('value', '>f8')])
+
+
+def _read_archive(fh, archive, now):
+    """Read the valid points of a whisper archive as NumPy arrays.
+
+    Raises CorruptWhisperFile if the archive is truncated.
+    """
+    fh.seek(archive['offset'])
+    data = fh.read(archive['size'])
+    if len(data) != archive['size']:
+        raise whisper.CorruptWhisperFile('Truncated archive', fh.name)
+    points = numpy.frombuffer(data, dtype=_POINT_DTYPE)
+    times = points['time'].astype(numpy.int64)
+    # Slots that were never written or hold points older than the
+    # retention are not part of the archive.
+    valid = ((times > now - archive['retention']) & (times <= now) &
+             (times % archive['secondsPerPoint'] == 0))
+    return times[valid], points['value'][valid]
+
+
+def _fast_heal_metric(src, dst, start_time, end_time, overwrite):
+    """Heal a whisper file with NumPy, like carbonate's heal_metric.
+
+    Only the points missing from dst (or all of them with overwrite) and
+    between start_time and end_time are copied from src. Returns False,
+    without changing anything, if the files can't be healed this way.
+    """
+    if numpy is None:
+        return False
+
+    try:
+        src_info = whisper.info(src)
+        dst_info = whisper.info(dst)
+        if not src_info or not dst_info:
+            return False
+        src_archives = src_info['archives']
+        dst_archives = dst_info['archives']
+        if ([(a['secondsPerPoint'], a['points']) for a in src_archives] !=
+                [(a['secondsPerPoint'], a['points']) for a in dst_archives]):
+            return False
+
+        now = int(time.time())
+        times = []
+        values = []
+        with open(src, 'rb') as src_fh, open(dst, 'rb') as dst_fh:
+            # Archives go from the highest to the lowest precision. Each
+            # one only provides points older than the previous ones.
+            until_time = end_time
+            for archive in src_archives:
+                src_times, src_values = _read_archive(src_fh, archive, now)
+                mask = (src_times >= start_time) & (src_times <= until_time)
+                if not overwrite:
+                    dst_times, _ = _read_archive(dst_fh, archive, now)
+                    mask &= ~numpy.isin(src_times, dst_times)
+                times.append(src_times[mask])
+                values.append(src_values[mask])
+                until_time = min(until_time, now - archive['retention'] - 1)
+    except (IOError, OSError, whisper.CorruptWhisperFile):
+        return False
+
+    points = list(zip(numpy.concatenate(times).tolist(),
+                      numpy.concatenate(values).tolist()))
+    whisper.update_many(dst, points, now=now)
+    return True
+
+
+def _remove_dir(dirname):
+    """Starts removing a directory and returns the process doing it.
+
+    find(1) is much faster than shutil.rmtree() on directories with many
+    files.
+    """
+    return subprocess.Popen(['find', dirname, '-depth', '-delete'])
+
+
+def _copy_file_range(fsrc, fdst):
+    """Copy a file within the kernel, returns False if not possible."""
+    if not hasattr(os, 'copy_file_range'):
+        return False
+    try:
+        while os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30):
+            pass
+    except OSError:
+        # Not supported for these files, e.g. on older kernels.
+        return False
+    return True
+
+
+def _copy_file(src, dst):
+    """Copy src to dst, within the kernel when possible.
+
+    src is copied to a temporary file renamed to dst, so that dst is never
+    seen partially written.
+    """
+    dirname = os.path.dirname(dst)
+    _makedirs(dirname)
+    fd, tmp = tempfile.mkstemp(
+        prefix='.%s.' % os.path.basename(dst), dir=dirname)
+    try:
+        with open(src, 'rb') as fsrc, os.fdopen(fd, 'wb') as fdst:
+            if not _copy_file_range(fsrc, fdst):
+                # Start over, part of the file may have been copied.
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+                shutil.copyfileobj(fsrc, fdst)
+        # mkstemp() makes files only accessible to us.
+        shutil.copymode(src, tmp)
+        os.rename(tmp, dst)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def _is_empty(path):
+    """Whether path is missing or empty."""
+    try:
+        return os.stat(path).st_size == 0
+    except OSError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+        return True
+
+
+class _FileLock(object):
+
+    """Exclusive lock on a file, see flock(2).
+
+    Works across processes, and threads as long as they don't share the
+    lock object.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self._path, 'a')
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        # Closing the file releases the lock.
+        self._file.close()
+        self._file = None
+
+
+def _heal_lock_path(lock_dir, metric):
+    """Lock file in lock_dir to hold while healing metric."""
+    # whisper already locks the files it updates, and we can't lock
+    # files we are about to replace, so metrics share a fixed set of
+    # lock files. Unlike hash(), crc32 is the same in all processes.
+    if not isinstance(metric, bytes):
+        metric = metric.encode('utf-8')
+    n = (zlib.crc32(metric) & 0xffffffff) % _HEAL_LOCKS
+    return os.path.join(lock_dir, '%d.lock' % n)
+
+
+def _heal_metric(batch, src, dst):
+    """Heal dst with src, see _heal()."""
+    # Nothing to merge, take the remote file as is.
+    if _is_empty(dst):
+        _copy_file(src, dst)
+        return
+    if batch.fast_heal and _fast_heal_metric(
+            src, dst, batch.start_time, batch.end_time, batch.overwrite):
+        return
+    kwargs = {}
+    if HAVE_HEAL_WITH_TIME_RANGE:
+        kwargs['start_time'] = batch.start_time
+        kwargs['end_time'] = batch.end_time
+    if HAVE_HEAL_WITH_OVERWRITE:
+        kwargs['overwrite'] = batch.overwrite
+    carbonate_sync.heal_metric(src, dst, **kwargs)
+
+
 def _heal(batch):
     """Heal whisper files.
 
     This method will backfill data present in files in the
     staging dir if not present in the local files for
     points between 'start' and 'stop' (unix timestamps).
+
+    If batch.lock_dir is set, metrics are locked while being healed so
+    that batches from different nodes can be healed at the same time.
     """
-    for metric in batch.metrics_fs:
+    for metric in batch.metrics_view:
         src = os.path.join(batch.staging_dir, metric)
         dst = os.path.join(STORAGE_DIR, metric)
         try:
-            kwargs = {}
-            if HAVE_HEAL_WITH_TIME_RANGE:
-                kwargs['start_time'] = batch.start_time
-                kwargs['end_time'] = batch.end_time
-            if HAVE_HEAL_WITH_OVERWRITE:
-                kwargs['overwrite'] = batch.overwrite
-            carbonate_sync.heal_metric(src, dst, **kwargs)
+            if batch.lock_dir is None:
+                _heal_metric(batch, src, dst)
+            else:
+                with _FileLock(_heal_lock_path(batch.lock_dir, metric)):
+                    _heal_metric(batch, src, dst)
         except Exception as e:
             logging.exception("Failed to heal %s" % dst)
+        finally:
+            _clear_header_cache()
 
     return batch
 
 
+# Batch shared by all the tasks of a heal worker, see _init_heal_worker().
+_heal_batch = None
+
+
+def _init_heal_worker(batch):
+    """Stores the batch shared by all the tasks of this heal worker.
+
+    This way, heal tasks only have to carry their staging dir and list of
+    metrics.
+    """
+    global _heal_batch
+    _heal_batch = batch
+
+
+def _heal_worker(task):
+    """Heals metrics using the batch given to _init_heal_worker()."""
+    staging_dir, metrics_fs = task
+    _heal(_heal_batch._replace(
+        staging_dir=staging_dir, metrics_fs=metrics_fs))
+    return len(metrics_fs)
+
+
 class _Batch(collections.namedtuple('_Batch',
                                     ['staging_dir', 'metrics_fs',
                                      'start_time', 'end_time',
                                      'remote_user', 'remote_node',
                                      'rsync_options', 'ssh_options',
-                                     'overwrite'])):
+                                     'overwrite', 'fast_heal',
+                                     'lock_dir', 'idx_start', 'idx_stop'])):
 
-    def split_chunks(self, chunksize):
+    """Metrics to fetch and heal, with the options to do so.
+
+    The metrics of a batch are metrics_fs[idx_start:idx_stop], this way
+    batches split from the same one share a single list.
+    """
+
+    def split_chunks(self, chunksize, max_bytes=None):
+        """Splits this batch in batches of at most chunksize metrics.
+
+        If max_bytes is set, a batch is also cut as soon as the list of
+        its files, as given to rsync, reaches max_bytes.
+        """
+        chunksize = max(1, chunksize)
+        start, stop = self.idx_start, self._idx_stop
+        if not max_bytes:
+            return [
+                self._replace(idx_start=n, idx_stop=min(n + chunksize, stop))
+                for n in range(start, stop, chunksize)]
+
+        # The list is written in a text file, see _fetch_from_remote().
+        encoding = locale.getpreferredencoding(False)
         res = []
-        for n in range(0, len(self.metrics_fs), max(1, chunksize)):
-            new_batch = self._replace(
-                metrics_fs=self.metrics_fs[n:n + chunksize])
-            res.append(new_batch)
+        size = 0
+        for n in range(start, stop):
+            name = self.metrics_fs[n]
+            if not isinstance(name, bytes):
+                name = name.encode(encoding)
+            size += len(name) + 1
+            if n + 1 - start >= chunksize or size >= max_bytes:
+                res.append(self._replace(idx_start=start, idx_stop=n + 1))
+                start = n + 1
+                size = 0
+        if start < stop:
+            res.append(self._replace(idx_start=start, idx_stop=stop))
         return res
 
+    def __reduce__(self):
+        # Only pickle our own metrics, not the whole shared list.
+        batch = self._replace(
+            metrics_fs=self.metrics_view, idx_start=0, idx_stop=None)
+        return (_Batch, tuple(batch))
+
+    @property
+    def _idx_stop(self):
+        if self.idx_stop is None:
+            return len(self.metrics_fs)
+        return self.idx_stop
+
+    @property
+    def metrics_view(self):
+        return self.metrics_fs[self.idx_start:self._idx_stop]
+
     @property
     def metrics_number(self):
-        return len(self.metrics_fs)
+        return self._idx_stop - self.idx_start
+
+
+# Use NumPy to heal by default, when available, don't lock metrics and
+# take all of them.
+_Batch.__new__.__defaults__ = (True, None, 0, None)
+
 
+class _Throttle(object):
 
-def _fetch_merge(fetch_batches, update_cb):
-    """fetch & merge files in the staging directory with local files."""
+    """Wraps a progress callback to only call it when needed.
+
+    The callback is called when the progress changed, at most once every
+    interval seconds. flush() reports the last progress if it was skipped.
+    """
+
+    def __init__(self, callback, interval=0.1):
+        self._callback = callback
+        self._interval = interval
+        self._reported = None
+        self._last = None
+        self._last_time = 0
+
+    def __call__(self, progress):
+        self._last = progress
+        now = time.time()
+        if (progress != self._reported and
+                now - self._last_time >= self._interval):
+            self._report(now)
+
+    def flush(self):
+        if self._last != self._reported:
+            self._report(time.time())
+
+    def _report(self, now):
+        self._callback(self._last)
+        self._reported = self._last
+        self._last_time = now
+
+
+def _fetch_merge(fetch_batches, update_cb, rsync_workers=None,
+                 heal_workers=None):
+    """fetch & merge files in the staging directory with local files.
+
+    Unless PARALLEL is False, rsync_workers and heal_workers are the
+    pools to use, heal_workers being initialized with _init_heal_worker().
+    """
     total_metrics_number = sum(b.metrics_number for b in fetch_batches)
 
     # Estimates how many percent of total time is fetching data
     fetch_percent = 10
     heal_percent = 100 - fetch_percent
 
+    # Avoids redrawing the progress bar for each batch.
+    update_cb = _Throttle(update_cb)
     work_done = 0
     update_cb(work_done)
+    if not fetch_batches:
+        update_cb(100)
+        update_cb.flush()
+        return
 
     if not PARALLEL:
         for batch in fetch_batches:
@@ -230,32 +684,30 @@ def _fetch_merge(fetch_batches, update_cb):
             work_done += batch.metrics_number * (fetch_percent + heal_percent)
             update_cb(work_done // total_metrics_number)
     else:
-        rsync_workers = multiprocessing.Pool(_MAX_PARALLEL_RSYNC)
-        heal_workers = multiprocessing.Pool()
+        # Subdivides heal batches to ensure we use all CPUs.
+        # Smaller batches increases serialisation overhead.
+        heal_chunksize = max(
+            1, total_metrics_number // (multiprocessing.cpu_count() * 16))
+        healing = collections.deque()
 
         for batch_fetched in rsync_workers.imap_unordered(
                 _fetch_from_remote, fetch_batches):
             # Updates estimate of work done
             work_done += fetch_percent * batch_fetched.metrics_number
+
+            # Heal asynchronously, we keep fetching in the meantime.
+            for batch in batch_fetched.split_chunks(heal_chunksize):
+                healing.append(heal_workers.apply_async(
+                    _heal_worker, ((batch.staging_dir, batch.metrics_view),)))
+            while healing and healing[0].ready():
+                work_done += heal_percent * healing.popleft().get()
             update_cb(work_done // total_metrics_number)
 
-            # Subdivides heal batches to ensure we use all CPUs.
-            # Smaller batches increases serialisation overhead.
-            heal_chunksize = batch_fetched.metrics_number / \
-                multiprocessing.cpu_count()
-            heal_batches = batch_fetched.split_chunks(heal_chunksize)
-            # This waits for all chunks of a fetch to heal before healing the
-            # next fetch.
-            # This is OK as heal chunks are all about the same size and will
-            # complete at once.
-            for batch_healed in heal_workers.imap_unordered(
-                    _heal, heal_batches):
-                work_done += heal_percent * batch_healed.metrics_number
-                update_cb(work_done // total_metrics_number)
+        while healing:
+            work_done += heal_percent * healing.popleft().get()
+            update_cb(work_done // total_metrics_number)
 
-        for workers in rsync_workers, heal_workers:
-            workers.close()
-            workers.join()
+    update_cb.flush()
 
 
 def _get_nodes(config, cluster_name, node=None):
@@ -282,9 +734,15 @@ def _parse_args():
         help='Name of the local node (same as in carbonate.conf).')
 
     parser.add_argument(
-        '-b', '--batch-size',
-        default=1000,
-        help='Batch size for fetching metrics.')
+        '-b', '--batch-size', type=int,
+        default=10000,
+        help='Maximum number of metrics per batch for fetching metrics.')
+
+    parser.add_argument(
+        '--batch-bytes', type=int,
+        default=256 * 1024,
+        help='Maximum size in bytes of the list of files per batch for '
+        'fetching metrics.')
 
     parser.add_argument(
         '--ssh-options',
@@ -325,6 +783,11 @@ def _parse_args():
             default=False,
             help='Overwrite local data with remote data (default: false).')
 
+    parser.add_argument(
+        '--no-fast-heal', dest='fast_heal', action='store_false',
+        help='Heal with carbonate instead of NumPy, which is used by '
+        'default when installed.')
+
     args = parser.parse_args()
     if args.remote_cluster is None:
         args.remote_cluster = args.cluster
@@ -332,10 +795,103 @@ def _parse_args():
     # We want lists for these options.
     args.rsync_options = shlex.split(args.rsync_options)
     args.ssh_options = shlex.split(args.ssh_options)
-    args.exclude = args.exclude.split(',')
+    args.exclude = [p for p in args.exclude.split(',') if p]
+    # Compiled once for all nodes.
+    args.exclude_re = None
+    if args.exclude:
+        try:
+            args.exclude_re = _compile_exclude(args.exclude)
+        except re.error as e:
+            parser.error('Invalid --exclude regexp: %s' % e)
     return args
 
 
+def _sync_node(sieve, args, node, batch, update_cb, rsync_workers=None,
+               heal_workers=None):
+    """Fetch and merge metrics of a remote node with local files.
+
+    sieve selects the metrics of the local node and batch holds the
+    options for all nodes, see _fetch_merge() for the workers.
+
+    Returns the process cleaning up the staging dir.
+    """
+    info('- %s: Listing metrics' % node)
+
+    metrics = _list_metrics(
+        sieve, node, args.exclude_re, ssh_options=args.ssh_options)
+    staging_dir = _make_staging_dir(args.temp_dir, node)
+    # Same as carbonate_util.metric_to_fs(), without a call per metric.
+    metrics_fs = [m.replace('.', '/') + '.wsp' for m in metrics]
+
+    batches = batch._replace(
+        staging_dir=staging_dir,
+        metrics_fs=metrics_fs,
+        remote_node=node,
+    ).split_chunks(args.batch_size, max_bytes=args.batch_bytes)
+
+    info('- %s: Merging and fetching %s metrics' % (node, len(metrics)))
+    _fetch_merge(batches, update_cb, rsync_workers=rsync_workers,
+                 heal_workers=heal_workers)
+
+    info('  %s: Cleaning up' % node)
+    # Don't wait for it, other nodes can go on in the meantime.
+    cleanup = _remove_dir(staging_dir)
+    for host in node, '%s@%s' % (batch.remote_user, node):
+        _ssh_exit(host, ssh_options=args.ssh_options)
+
+    info('  %s: Done' % node)
+    return cleanup
+
+
+def _sync_nodes(sieve, args, remote_nodes, batch, rsync_workers=None,
+                heal_workers=None):
+    """Sync with remote nodes, several at a time."""
+    total_nodes = len(remote_nodes)
+    # Overall progress is the average of the progress of each node.
+    progress = [0] * total_nodes
+    # Cleanups of the nodes done so far, even if another node fails.
+    cleanups = []
+    lock = threading.Lock()
+
+    try:
+        with progressbar.ProgressBar(redirect_stdout=True) as bar:
+            def sync_node(n):
+                def update_cb(percent):
+                    with lock:
+                        progress[n] = percent
+                        bar.update(sum(progress) // total_nodes)
+
+                node = remote_nodes[n]
+                info('- Syncing node %s (%d/%d)' %
+                     (node, n + 1, total_nodes))
+                cleanup = _sync_node(sieve, args, node, batch, update_cb,
+                                     rsync_workers=rsync_workers,
+                                     heal_workers=heal_workers)
+                with lock:
+                    cleanups.append(cleanup)
+
+            if not PARALLEL:
+                for n in range(total_nodes):
+                    sync_node(n)
+            elif remote_nodes:
+                # Nodes are mostly waiting on subprocesses, threads are
+                # enough.
+                node_workers = multiprocessing.pool.ThreadPool(
+                    min(total_nodes, _MAX_PARALLEL_NODES))
+                try:
+                    node_workers.map(sync_node, range(total_nodes))
+                finally:
+                    # Let the other nodes finish if one failed.
+                    node_workers.close()
+                    node_workers.join()
+    finally:
+        info('- Waiting for clean up')
+        for cleanup in cleanups:
+            if cleanup.wait():
+                logging.warning('Failed to clean up a staging dir in %s',
+                                args.temp_dir)
+
+
 def main():
     log_format = (
         '%(asctime)s.%(msecs)d %(levelname)s %(module)s - '
@@ -353,7 +909,6 @@ def main():
     local_node = args.node
     remote_cluster = args.remote_cluster
     remote_nodes = _get_nodes(config, remote_cluster, node=local_node)
-    base_dir = args.temp_dir
 
     if getpass.getuser() != local_user:
         _abort('This program must be run as the "%s" user' % local_user)
@@ -363,38 +918,55 @@ def main():
 
     remote_nodes = list(remote_nodes)
     random.shuffle(remote_nodes)
-    for n, node in enumerate(remote_nodes):
-        info('- Syncing node %s (%d/%d)' % (node, n + 1, len(remote_nodes)))
-        info('- %s: Listing metrics' % node)
-
-        metrics = _list_metrics(
-            config, local_cluster, local_node, node, args.exclude,
-            ssh_options=args.ssh_options)
-        staging_dir = _make_staging_dir(base_dir, node)
-        metrics_fs = [carbonate_util.metric_to_fs(m) for m in metrics]
-
-        batches = _Batch(
-            staging_dir=staging_dir,
-            metrics_fs=metrics_fs,
-            start_time=args.start_time if HAVE_HEAL_WITH_TIME_RANGE else 0,
-            end_time=args.end_time if HAVE_HEAL_WITH_TIME_RANGE else time.now(),
-            remote_user=config.ssh_user(remote_cluster),
-            remote_node=node,
-            rsync_options=args.rsync_options,
-            ssh_options=args.ssh_options,
-            overwrite=args.overwrite if HAVE_HEAL_WITH_OVERWRITE else False,
-        ).split_chunks(args.batch_size)
-
-        info('- %s: Merging and fetching %s metrics' % (node, len(metrics)))
-        with progressbar.ProgressBar(redirect_stdout=True) as bar:
-            _fetch_merge(batches, bar.update)
 
-        info('  %s: Cleaning up' % node)
-        shutil.rmtree(staging_dir)
-
-        info('  %s: Done' % node)
+    # Private to this run, mkdtemp() makes them only accessible to us.
+    control_dir = tempfile.mkdtemp(prefix='carbonate-sync-')
+    args.ssh_options = _ssh_control_options(control_dir) + args.ssh_options
+    # Nodes are healed at the same time and have metrics in common.
+    lock_dir = tempfile.mkdtemp(prefix='carbonate-sync-locks-')
+
+    # Shared by all nodes.
+    # Remote metrics are only listed several times with replicas.
+    sieve_cache_size = 0
+    if config.replication_factor(remote_cluster) > 1:
+        sieve_cache_size = _SIEVE_CACHE_SIZE
+    sieve = _Sieve(
+        carbonate_cluster.Cluster(config, local_cluster), local_node,
+        cache_size=sieve_cache_size)
+    # Options common to all nodes.
+    batch = _Batch(
+        staging_dir=None,
+        metrics_fs=[],
+        start_time=args.start_time if HAVE_HEAL_WITH_TIME_RANGE else 0,
+        end_time=args.end_time if HAVE_HEAL_WITH_TIME_RANGE else time.time(),
+        remote_user=config.ssh_user(remote_cluster),
+        remote_node=None,
+        rsync_options=args.rsync_options,
+        ssh_options=args.ssh_options,
+        overwrite=args.overwrite if HAVE_HEAL_WITH_OVERWRITE else False,
+        fast_heal=args.fast_heal,
+        lock_dir=lock_dir,
+    )
+
+    # Workers are shared by all nodes. Being a single pool, rsync workers
+    # also bound the number of rsyncs running at the same time.
+    rsync_workers = heal_workers = None
+    try:
+        if PARALLEL:
+            rsync_workers = multiprocessing.Pool(_MAX_PARALLEL_RSYNC)
+            heal_workers = multiprocessing.Pool(
+                initializer=_init_heal_worker, initargs=(batch,))
+        _sync_nodes(sieve, args, remote_nodes, batch,
+                    rsync_workers=rsync_workers, heal_workers=heal_workers)
+    finally:
+        for workers in rsync_workers, heal_workers:
+            if workers is not None:
+                workers.close()
+                workers.join()
+        for dirname in control_dir, lock_dir:
+            shutil.rmtree(dirname, ignore_errors=True)
 
-        info('')
+    info('')
 
 
 if __name__ == '__main__':
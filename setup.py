@@ -37,6 +37,9 @@ setup(
       "carbonate",
       "progressbar2",
     ],
+    extras_require={
+      "numpy": ["numpy"],
+    },
     test_suite='tests',
     cmdclass={'install_scripts': my_install_scripts},
     entry_points={
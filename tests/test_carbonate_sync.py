@@ -1,5 +1,9 @@
+import locale
+import multiprocessing
 import os
+import pickle
 import shutil
+import sys
 import tempfile
 import time
 import unittest
@@ -16,6 +20,13 @@ class TestCarbonateSync(unittest.TestCase):
         ret = carbonate_sync._run('echo test la', shell=True)
         self.assertEquals(ret, ['test la'])
 
+    def test_run_lines(self):
+        ret = carbonate_sync._run_lines('echo a; echo; echo b', shell=True)
+        self.assertEquals(list(ret), ['a', 'b'])
+
+        ret = carbonate_sync._run_lines('echo a; exit 1', shell=True)
+        self.assertRaises(carbonate_sync.Error, list, ret)
+
     def test_filter_metrics(self):
         exclude = ['^carbon\.',  '\.foo$']
         metrics = [
@@ -23,10 +34,295 @@ class TestCarbonateSync(unittest.TestCase):
             'carbonfoo.bar',
             'bar.foo'
         ]
-        metrics = carbonate_sync._filter_metrics(metrics, exclude)
+        exclude_re = carbonate_sync._compile_exclude(exclude)
+        metrics = list(carbonate_sync._filter_metrics(metrics, exclude_re))
         self.assertEquals(metrics, ['carbonfoo.bar'])
 
+        # Inline flags and groups only apply to their own regexp.
+        exclude = ['^carbon\\.', '(?i)^foo\\.', '(b)\\1']
+        metrics = [
+            'carbon.bar',
+            'Carbon.bar',
+            'FOO.bar',
+            'bar.abba',
+            'bar.foo',
+        ]
+        exclude_re = carbonate_sync._compile_exclude(exclude)
+        metrics = list(carbonate_sync._filter_metrics(metrics, exclude_re))
+        self.assertEquals(metrics, ['Carbon.bar', 'bar.foo'])
+
+    def test_sieve(self):
+        class Cluster(object):
+            def __init__(self):
+                self.lookups = []
+
+            def getDestinations(self, metric):
+                self.lookups.append(metric)
+                return [('foo' if metric.startswith('foo') else 'bar', 'a')]
+
+        metrics = ['foo.a', 'bar.a', 'foo.b']
+        cluster = Cluster()
+        sieve = carbonate_sync._Sieve(cluster, 'foo')
+        self.assertEqual(list(sieve.filter(metrics)), ['foo.a', 'foo.b'])
+        self.assertEqual(list(sieve.filter(metrics)), ['foo.a', 'foo.b'])
+        # Without a cache, metrics are looked up each time.
+        self.assertEqual(cluster.lookups, metrics * 2)
+
+        cluster = Cluster()
+        sieve = carbonate_sync._Sieve(cluster, 'foo', cache_size=2)
+        self.assertEqual(list(sieve.filter(metrics)), ['foo.a', 'foo.b'])
+        self.assertEqual(list(sieve.filter(metrics)), ['foo.a', 'foo.b'])
+        # Only the metrics that fit in the cache are looked up once.
+        self.assertEqual(cluster.lookups, metrics + ['foo.b'])
+
+        # Whole destinations match too.
+        sieve = carbonate_sync._Sieve(Cluster(), 'foo:a')
+        self.assertEqual(list(sieve.filter(metrics)), ['foo.a', 'foo.b'])
+
+    def test_split_chunks(self):
+        batch = carbonate_sync._Batch(
+            staging_dir='staging', metrics_fs=['a', 'bb', 'ccc', 'd', 'e'],
+            start_time=0, end_time=0, remote_user='graphite',
+            remote_node='foo', rsync_options=[], ssh_options=[],
+            overwrite=False)
+
+        chunks = [b.metrics_view for b in batch.split_chunks(2)]
+        self.assertEqual(chunks, [['a', 'bb'], ['ccc', 'd'], ['e']])
+
+        # 'a\nbb\n' is 5 bytes long.
+        chunks = [b.metrics_view for b in batch.split_chunks(3, max_bytes=5)]
+        self.assertEqual(chunks, [['a', 'bb'], ['ccc', 'd'], ['e']])
+
+        chunks = [b.metrics_view
+                  for b in batch.split_chunks(2, max_bytes=100)]
+        self.assertEqual(chunks, [['a', 'bb'], ['ccc', 'd'], ['e']])
+
+        # Chunks share the list of metrics, but only pickle their own.
+        chunk = batch.split_chunks(2)[1]
+        self.assertIs(chunk.metrics_fs, batch.metrics_fs)
+        chunk = pickle.loads(pickle.dumps(chunk))
+        self.assertEqual(chunk.metrics_fs, ['ccc', 'd'])
+        self.assertEqual(chunk.metrics_view, ['ccc', 'd'])
+
+    @unittest.skipIf(
+        locale.getpreferredencoding(False).lower() not in ('utf-8', 'utf8'),
+        'Needs an UTF-8 locale')
+    def test_split_chunks_bytes(self):
+        batch = carbonate_sync._Batch(
+            staging_dir='staging', metrics_fs=[u'\xe9\xe9', u'a', u'b'],
+            start_time=0, end_time=0, remote_user='graphite',
+            remote_node='foo', rsync_options=[], ssh_options=[],
+            overwrite=False)
+
+        # Sizes are in bytes, u'\xe9\xe9\n' is 5 bytes long.
+        chunks = [b.metrics_view
+                  for b in batch.split_chunks(10, max_bytes=4)]
+        self.assertEqual(chunks, [[u'\xe9\xe9'], [u'a', u'b']])
+
+    def test_parse_args(self):
+        argv = sys.argv
+        try:
+            sys.argv = ['carbonate-sync']
+            args = carbonate_sync._parse_args()
+            self.assertEqual(args.batch_size, 10000)
+            self.assertEqual(args.batch_bytes, 256 * 1024)
+
+            sys.argv = ['carbonate-sync', '-b', '10', '--batch-bytes', '100']
+            args = carbonate_sync._parse_args()
+            self.assertEqual(args.batch_size, 10)
+            self.assertEqual(args.batch_bytes, 100)
+        finally:
+            sys.argv = argv
+
+    def test_throttle(self):
+        calls = []
+        throttle = carbonate_sync._Throttle(calls.append, interval=3600)
+        for progress in 0, 0, 5, 10:
+            throttle(progress)
+        self.assertEqual(calls, [0])
+        throttle.flush()
+        self.assertEqual(calls, [0, 10])
+        throttle.flush()
+        self.assertEqual(calls, [0, 10])
+
+    def test_heal_copy(self):
+        staging_dir = tempfile.mkdtemp(prefix='staging')
+        storage_dir = tempfile.mkdtemp(prefix='storage')
+        carbonate_sync.STORAGE_DIR = storage_dir
+        remote = os.path.join(staging_dir, 'foo', 'bar.wsp')
+        local = os.path.join(storage_dir, 'foo', 'bar.wsp')
+        os.mkdir(os.path.dirname(remote))
+        whisper.create(remote, [(1, 10)])
+        whisper.update(remote, 1.0)
+
+        batch = carbonate_sync._Batch(
+            staging_dir=staging_dir, metrics_fs=['foo/bar.wsp'],
+            start_time=0, end_time=int(time.time()), remote_user='graphite',
+            remote_node='foo', rsync_options=[], ssh_options=[],
+            overwrite=False)
+        # Missing local files are copied.
+        carbonate_sync._heal(batch)
+        with open(remote, 'rb') as f_remote, open(local, 'rb') as f_local:
+            self.assertEqual(f_remote.read(), f_local.read())
+
+        # And so are empty ones.
+        open(local, 'w').close()
+        carbonate_sync._heal(batch)
+        with open(remote, 'rb') as f_remote, open(local, 'rb') as f_local:
+            self.assertEqual(f_remote.read(), f_local.read())
+
+        # Even if copying within the kernel fails midway.
+        def copy_file_range(fsrc, fdst):
+            fdst.write(b'garbage')
+            return False
+
+        open(local, 'w').close()
+        real_copy_file_range = carbonate_sync._copy_file_range
+        carbonate_sync._copy_file_range = copy_file_range
+        try:
+            carbonate_sync._heal(batch)
+        finally:
+            carbonate_sync._copy_file_range = real_copy_file_range
+        with open(remote, 'rb') as f_remote, open(local, 'rb') as f_local:
+            self.assertEqual(f_remote.read(), f_local.read())
+        # Files are copied to a temporary file renamed when done.
+        self.assertEqual(os.listdir(os.path.dirname(local)), ['bar.wsp'])
+
+        shutil.rmtree(staging_dir)
+        shutil.rmtree(storage_dir)
+
+    def test_heal_nodes(self):
+        staging_dir = tempfile.mkdtemp(prefix='staging')
+        storage_dir = tempfile.mkdtemp(prefix='storage')
+        lock_dir = tempfile.mkdtemp(prefix='locks')
+        carbonate_sync.STORAGE_DIR = storage_dir
+        now = int(time.time())
+        metrics_fs = ['foo/bar%d.wsp' % i for i in range(200)]
+        # Half of the metrics are missing locally.
+        os.mkdir(os.path.join(storage_dir, 'foo'))
+        for metric in metrics_fs[::2]:
+            whisper.create(os.path.join(storage_dir, metric), [(1, 10)])
+
+        # Nodes are replicas with the same metrics, but different points.
+        batches = []
+        for n, node in enumerate(['node1', 'node2']):
+            node_dir = os.path.join(staging_dir, node)
+            os.makedirs(os.path.join(node_dir, 'foo'))
+            for metric in metrics_fs:
+                remote = os.path.join(node_dir, metric)
+                whisper.create(remote, [(1, 10)])
+                whisper.update(remote, float(n), now - n - 1)
+            batches.append(carbonate_sync._Batch(
+                staging_dir=node_dir, metrics_fs=metrics_fs,
+                start_time=0, end_time=now, remote_user='graphite',
+                remote_node=node, rsync_options=[], ssh_options=[],
+                overwrite=False, lock_dir=lock_dir))
+
+        # Healing both nodes at the same time doesn't lose any point.
+        workers = multiprocessing.Pool(len(batches))
+        workers.map(carbonate_sync._heal, batches)
+        workers.close()
+        workers.join()
+        for metric in metrics_fs:
+            _, values = whisper.fetch(
+                os.path.join(storage_dir, metric), now - 10, now)
+            self.assertEqual(sorted(v for v in values if v is not None),
+                             [0.0, 1.0], metric)
+
+        shutil.rmtree(staging_dir)
+        shutil.rmtree(storage_dir)
+        shutil.rmtree(lock_dir)
+
     def test_heal(self):
+        self._test_heal(fast_heal=False)
+
+    @unittest.skipIf(carbonate_sync.numpy is None, 'NumPy is not installed')
+    def test_fast_heal(self):
+        self._test_heal(fast_heal=True)
+
+    @unittest.skipIf(carbonate_sync.numpy is None, 'NumPy is not installed')
+    def test_fast_heal_archives(self):
+        staging_dir = tempfile.mkdtemp(prefix='staging')
+        storage_dir = tempfile.mkdtemp(prefix='storage')
+        carbonate_sync.STORAGE_DIR = storage_dir
+        remote = os.path.join(staging_dir, 'foo.wsp')
+        local = os.path.join(storage_dir, 'foo.wsp')
+        resolution = [(60, 10), (300, 24), (3600, 10)]
+        whisper.create(local, resolution)
+        whisper.create(remote, resolution)
+
+        # Points of each archive that no point of the previous archive is
+        # aggregated in, by archive. The first archive has gaps where the
+        # second one has aggregates, they must not be copied to the first.
+        now = int(time.time())
+        times = [
+            [now - now % 60 - 60 * k for k in range(1, 9)
+             if (now - now % 60 - 60 * k) % 300],
+            [now - now % 300 - 300 * k for k in range(3, 20)],
+            [now - now % 3600 - 3600 * k for k in range(3, 9)],
+        ]
+        remote_points = [
+            dict((t, float(n * 100 + i)) for i, t in enumerate(ts))
+            for n, ts in enumerate(times)]
+        local_points = [
+            dict((t, -1.0) for t in ts[1::3]) for ts in times]
+        for points in remote_points:
+            whisper.update_many(remote, list(points.items()))
+        for points in local_points:
+            whisper.update_many(local, list(points.items()))
+
+        attr = {
+            'staging_dir': staging_dir,
+            'metrics_fs': ['foo.wsp'],
+            'start_time': 0,
+            'end_time': now,
+            'remote_user': 'graphite',
+            'remote_node': 'foo',
+            'rsync_options': [],
+            'ssh_options': [],
+            'overwrite': False,
+        }
+        carbonate_sync._heal(carbonate_sync._Batch(**attr))
+
+        # Missing points are added to each archive. Unlike carbonate, which
+        # overwrites the first local point after a gap, all the local
+        # points are kept.
+        for n, ts in enumerate(times):
+            points = self._archive_points(local, n, now)
+            expected = dict(remote_points[n])
+            expected.update(local_points[n])
+            if n > 0:
+                points = dict((t, points.get(t)) for t in ts)
+            self.assertEqual(points, expected)
+
+        attr['overwrite'] = True
+        carbonate_sync._heal(carbonate_sync._Batch(**attr))
+
+        for n, ts in enumerate(times):
+            points = self._archive_points(local, n, now)
+            if n > 0:
+                points = dict((t, points.get(t)) for t in ts)
+            self.assertEqual(points, remote_points[n])
+
+        # Truncated files are left to carbonate.
+        with open(remote, 'r+b') as f:
+            f.truncate(os.path.getsize(remote) - 1)
+        self.assertFalse(carbonate_sync._fast_heal_metric(
+            remote, local, 0, now, False))
+
+        shutil.rmtree(staging_dir)
+        shutil.rmtree(storage_dir)
+
+    def _archive_points(self, path, archive, now):
+        """Points of an archive of a whisper file, as a dict."""
+        archive = whisper.info(path)['archives'][archive]
+        with open(path, 'rb') as f:
+            (start, end, step), values = getattr(whisper, '__archive_fetch')(
+                f, archive, now - archive['retention'], now)
+        return dict((t, v) for t, v in zip(range(start, end, step), values)
+                    if v is not None)
+
+    def _test_heal(self, fast_heal):
         staging_dir = tempfile.mkdtemp(prefix='staging')
         storage_dir = tempfile.mkdtemp(prefix='storage')
         carbonate_sync.STORAGE_DIR = storage_dir
@@ -77,6 +373,7 @@ class TestCarbonateSync(unittest.TestCase):
             'rsync_options': [],
             'ssh_options': [],
             'overwrite': False,
+            'fast_heal': fast_heal,
         }
         batch = carbonate_sync._Batch(**attr)
 